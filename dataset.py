@@ -1,3 +1,5 @@
+import hashlib
+import json
 import os
 import random
 from collections import defaultdict
@@ -12,6 +14,9 @@ import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import cv2
 
+# 이미지 decode / resize 는 DataLoader worker 단위로 병렬화되므로 OpenCV 내부 thread pool 은 끔 (worker 수 x core 수 만큼 thread 가 생기는 것 방지)
+cv2.setNumThreads(0)
+
 IMG_EXTENSIONS = [
     ".jpg", ".JPG", ".jpeg", ".JPEG", ".png",
     ".PNG", ".ppm", ".PPM", ".bmp", ".BMP",
@@ -49,6 +54,52 @@ class ValAugmentation:
         return self.transform(image=image)['image']
 
 
+class BatchAugmentation:
+    """
+        DataLoader 에서 받은 uint8 image batch (N, C, H, W) 에 대해
+        HorizontalFlip / Normalize 를 GPU 에서 batch 단위로 한 번에 수행합니다.
+    """
+
+    def __init__(self, mean, std, hflip=False):
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        self.hflip = hflip
+
+    def __call__(self, images):
+        images = images.float() / 255.0
+        if self.hflip:
+            flip = torch.rand(images.size(0), device=images.device) < 0.5
+            images = torch.where(flip.view(-1, 1, 1, 1), images.flip(-1), images)
+        if self.mean.device != images.device:
+            self.mean = self.mean.to(images.device)
+            self.std = self.std.to(images.device)
+        return (images - self.mean) / self.std
+
+
+class GPUAugmentation:
+    """
+        BaseAugmentation 과 같은 augmentation 이지만 worker 에서는 CenterCrop / Resize 만 하고
+        uint8 tensor 를 반환합니다. 나머지는 train loop 에서 batch_transform 으로 GPU 에서 적용합니다.
+    """
+
+    def __init__(self, mean, std, **args):
+        self.transform = A.Compose([
+            A.CenterCrop(350, 300),
+            A.Resize(224, 224),
+            ToTensorV2(),
+        ])
+        self.batch_transform = BatchAugmentation(mean, std, hflip=True)
+
+    def __call__(self, image):
+        return self.transform(image=image)['image']
+
+
+class ValGPUAugmentation(GPUAugmentation):
+    def __init__(self, mean, std, **args):
+        super().__init__(mean, std, **args)
+        self.batch_transform = BatchAugmentation(mean, std, hflip=False)
+
+
 class AddGaussianNoise(object):
     """
         transform 에 없는 기능들은 이런식으로 __init__, __call__, __repr__ 부분을
@@ -134,20 +185,87 @@ class MaskBaseDataset(Dataset):
         "normal": MaskLabels.NORMAL
     }
 
-    image_paths = []
-    mask_labels = []
-    gender_labels = []
-    age_labels = []
+    # setup() / calc_statistics() 결과 중 cache 파일에 저장하는 속성들
+    _cache_attrs = ["image_paths", "mask_labels", "gender_labels", "age_labels", "mean", "std"]
 
-    def __init__(self, data_dir, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246), val_ratio=0.2):
+    def __init__(self, data_dir, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246), val_ratio=0.2, use_cache=True):
         self.data_dir = data_dir
         self.mean = mean
         self.std = std
         self.val_ratio = val_ratio
 
+        self.image_paths = []
+        self.mask_labels = []
+        self.gender_labels = []
+        self.age_labels = []
+
         self.transform = None
-        self.setup()
-        self.calc_statistics()
+        cache_key = self._cache_key()
+        if not (use_cache and self.load_cache(cache_key)):
+            self.setup()
+            self.calc_statistics()
+            if use_cache:
+                self.save_cache(cache_key)
+
+    @property
+    def cache_path(self):
+        return os.path.join(self.data_dir, f".{self.__class__.__name__}_cache.json")
+
+    def _cache_key(self):
+        # 아래 값들이 모두 같으면 같은 결과로 간주합니다 ("." 로 시작하는 cache 파일 자신은 제외)
+        with os.scandir(self.data_dir) as entries:
+            entries = [entry for entry in entries if not entry.name.startswith(".")]
+        profiles = sorted(entry.name for entry in entries)
+        # profile 폴더 안의 이미지가 추가 / 삭제되면 해당 폴더의 mtime 이 바뀝니다
+        mtime = max((entry.stat().st_mtime for entry in entries), default=0)
+        # split 은 seed_everything 으로 정해진 numpy RNG 상태에 따라 달라지므로 (= seed) key 에 포함
+        rng_state = np.random.get_state()
+        return {
+            "profiles": profiles,
+            "mtime": mtime,
+            "rng": [hashlib.sha1(rng_state[1].tobytes()).hexdigest(), int(rng_state[2])],
+            "val_ratio": self.val_ratio,
+            "mean": None if self.mean is None else [float(v) for v in self.mean],
+            "std": None if self.std is None else [float(v) for v in self.std],
+        }
+
+    def load_cache(self, cache_key):
+        """
+        이전 실행에서 저장한 image 목록 / label / split / 통계값을 불러옵니다.
+        cache 가 없거나 key 가 다르면 False 를 반환합니다.
+        """
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if cache.get("key") != cache_key:
+            return False
+
+        for attr in self._cache_attrs:
+            setattr(self, attr, cache[attr])
+        # 경로는 data_dir 기준 상대경로로 저장되어 있음 (실행 위치 / mount 위치가 달라도 사용 가능)
+        self.image_paths = [os.path.join(self.data_dir, path) for path in self.image_paths]
+        self.mean = None if self.mean is None else tuple(self.mean)
+        self.std = None if self.std is None else tuple(self.std)
+        # setup() 이 RNG 를 소비한 뒤의 상태로 맞춰서, cache 사용 여부와 관계없이 이후의 난수가 같도록 함
+        name, keys, pos, has_gauss, cached_gaussian = cache["rng_state"]
+        np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+        return True
+
+    def save_cache(self, cache_key):
+        cache = {attr: getattr(self, attr) for attr in self._cache_attrs}
+        cache["image_paths"] = [os.path.relpath(path, self.data_dir) for path in self.image_paths]
+        name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        cache["rng_state"] = [name, keys.tolist(), int(pos), int(has_gauss), float(cached_gaussian)]
+        cache["key"] = cache_key
+        tmp_path = f"{self.cache_path}.{os.getpid()}"  # 여러 process 가 동시에 써도 깨지지 않도록 rename 으로 교체
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(cache, f, default=lambda value: value.tolist())  # numpy 값 (계산된 mean / std 등)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:  # data_dir 에 쓰기 권한이 없는 경우 cache 없이 진행합니다
+            pass
 
     def setup(self):
         profiles = os.listdir(self.data_dir)
@@ -259,9 +377,17 @@ class MaskSplitByProfileDataset(MaskBaseDataset):
         이후 `split_dataset` 에서 index 에 맞게 Subset 으로 dataset 을 분기합니다.
     """
 
-    def __init__(self, data_dir, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246), val_ratio=0.2):
+    _cache_attrs = MaskBaseDataset._cache_attrs + ["indices"]
+
+    def __init__(self, data_dir, mean=(0.548, 0.504, 0.479), std=(0.237, 0.247, 0.246), val_ratio=0.2, use_cache=True):
         self.indices = defaultdict(list)
-        super().__init__(data_dir, mean, std, val_ratio)
+        super().__init__(data_dir, mean, std, val_ratio, use_cache)
+
+    def load_cache(self, cache_key):
+        if not super().load_cache(cache_key):
+            return False
+        self.indices = defaultdict(list, self.indices)
+        return True
 
     @staticmethod
     def _split_profile(profiles, val_ratio):
@@ -65,6 +65,14 @@ class F1Loss(nn.Module):
         return 1 - f1.mean()
 
 
+def mixed_cross_entropy(logits, target_a, target_b, lam):
+    """ lam * CE(logits, target_a) + (1 - lam) * CE(logits, target_b), sharing a single log_softmax. """
+    log_prob = F.log_softmax(logits, dim=-1)
+    log_prob_a = log_prob.gather(1, target_a.unsqueeze(1)).squeeze(1)
+    log_prob_b = log_prob.gather(1, target_b.unsqueeze(1)).squeeze(1)
+    return -(lam * log_prob_a + (1. - lam) * log_prob_b).mean()
+
+
 _criterion_entrypoints = {
     'cross_entropy': nn.CrossEntropyLoss,
     'focal': FocalLoss,
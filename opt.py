@@ -14,27 +14,33 @@ class SAM(torch.optim.Optimizer):
     @torch.no_grad()
     def first_step(self, zero_grad=False):
         grad_norm = self._grad_norm()
+        finite = torch.isfinite(grad_norm)  # False when fp16 gradients overflowed under AMP; checked on device (no sync)
         for group in self.param_groups:
-            scale = group["rho"] / (grad_norm + 1e-12)
+            scale = torch.where(finite, group["rho"] / (grad_norm + 1e-12), torch.zeros_like(grad_norm))
 
             for p in group["params"]:
                 if p.grad is None: continue
                 e_w = (torch.pow(p, 2) if group["adaptive"] else 1.0) * p.grad * scale.to(p)
+                e_w.nan_to_num_(nan=0.0)  # inf/nan gradients times a zero scale -> skip the ascent
                 p.add_(e_w)  # climb to the local maximum "w + e(w)"
                 self.state[p]["e_w"] = e_w
 
-        if zero_grad: self.zero_grad()
+        if zero_grad: self.zero_grad(set_to_none=True)
 
     @torch.no_grad()
-    def second_step(self, zero_grad=False):
+    def second_step(self, zero_grad=False, scaler=None):
         for group in self.param_groups:
             for p in group["params"]:
                 if p.grad is None: continue
                 p.sub_(self.state[p]["e_w"])  # get back to "w" from "w + e(w)"
 
-        self.base_optimizer.step()  # do the actual "sharpness-aware" update
+        # do the actual "sharpness-aware" update
+        if scaler is not None:
+            scaler.step(self.base_optimizer)  # skipped by the GradScaler on inf/nan gradients
+        else:
+            self.base_optimizer.step()
 
-        if zero_grad: self.zero_grad()
+        if zero_grad: self.zero_grad(set_to_none=True)
 
     @torch.no_grad()
     def step(self, closure=None):
@@ -2,7 +2,6 @@ import argparse
 import glob
 import json
 import os
-import multiprocessing
 from importlib import import_module
 
 import sys
@@ -12,23 +11,30 @@ import numpy as np
 import torch
 from torch.optim.lr_scheduler import StepLR
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
-from sklearn.metrics import classification_report, f1_score
+from sklearn.metrics import classification_report
 
 from dataset import SubDataset
 from loss import create_criterion
-from util import read_json, update_argument, draw_confusion_matrix, seed_everything, get_lr, increment_path, grid_image
+from util import read_json, update_argument, draw_confusion_matrix, seed_everything, get_lr, increment_path, grid_image, \
+    denormalize_batch, init_distributed, enable_fast_kernels, get_num_workers, shard_validation_set, wrap_model, \
+    all_reduce_sum, CUDAPrefetcher, AsyncCheckpointSaver, update_confusion_matrix, macro_f1_score, \
+    confusion_matrix_to_labels
 
 
 
 def train(data_dir, model_dir, args):
     seed_everything(args.seed)
+    enable_fast_kernels()
 
     save_dir = increment_path(os.path.join(model_dir, args.name))
 
     # -- settings
+    distributed, rank, local_rank = init_distributed()
+    is_main = rank == 0
     use_cuda = torch.cuda.is_available()
-    device = torch.device("cuda" if use_cuda else "cpu")
+    device = torch.device("cuda", local_rank) if use_cuda else torch.device("cpu")
 
     # -- dataset
     dataset_module = getattr(import_module("dataset"), args.dataset)  # default: MaskBaseDataset
@@ -51,17 +57,28 @@ def train(data_dir, model_dir, args):
         std=dataset.std,
     )
 
+    # GPU*Augmentation 은 flip / normalize 를 batch 단위로 GPU 에서 수행 (그 외 augmentation 은 None)
+    batch_transform = getattr(transform, "batch_transform", None)
+    val_batch_transform = getattr(validation_transform, "batch_transform", None)
+
     # -- data_loader
     train_set, val_set = dataset.split_dataset()
     
     train_set = SubDataset(train_set, transform=transform)
     val_set = SubDataset(val_set, transform=validation_transform)
 
+    train_sampler = DistributedSampler(train_set) if distributed else None
+    val_set = shard_validation_set(val_set, distributed)
+
+    num_workers = get_num_workers()
     train_loader = DataLoader(
         train_set,
         batch_size=args.batch_size,
-        num_workers=multiprocessing.cpu_count()//2,
-        shuffle=True,
+        num_workers=num_workers,
+        persistent_workers=True,
+        prefetch_factor=4,
+        shuffle=train_sampler is None,
+        sampler=train_sampler,
         pin_memory=use_cuda,
         drop_last=True,
     )
@@ -69,11 +86,15 @@ def train(data_dir, model_dir, args):
     val_loader = DataLoader(
         val_set,
         batch_size=args.valid_batch_size,
-        num_workers=multiprocessing.cpu_count()//2,
+        num_workers=num_workers,
+        persistent_workers=True,
+        prefetch_factor=4,
         shuffle=False,
         pin_memory=use_cuda,
         drop_last=True,
     )
+    train_prefetcher = CUDAPrefetcher(train_loader, device, memory_format=torch.channels_last)
+    val_prefetcher = CUDAPrefetcher(val_loader, device, memory_format=torch.channels_last)
 
     # -- model
     model_module = getattr(import_module("model"), args.model)  # default: BaseModel
@@ -81,8 +102,7 @@ def train(data_dir, model_dir, args):
         args.config,
         num_classes
     ).to(device)
-    
-    model = torch.nn.DataParallel(model)
+    model, eval_model = wrap_model(model, distributed, local_rank, compile=args.compile)
 
     # -- loss & metric
     criterion = create_criterion(args.criterion, classes=num_classes)  # default: cross_entropy
@@ -95,9 +115,16 @@ def train(data_dir, model_dir, args):
     scheduler = StepLR(optimizer, args.lr_decay_step, gamma=0.5)
 
     # -- logging
-    logger = SummaryWriter(log_dir=save_dir)
-    with open(os.path.join(save_dir, 'config.json'), 'w', encoding='utf-8') as f:
-        json.dump(vars(args), f, ensure_ascii=False, indent=4)
+    if is_main:
+        logger = SummaryWriter(log_dir=save_dir)
+        with open(os.path.join(save_dir, 'config.json'), 'w', encoding='utf-8') as f:
+            json.dump(vars(args), f, ensure_ascii=False, indent=4)
+
+    # -- mixed precision
+    scaler = torch.cuda.amp.GradScaler(enabled=use_cuda)
+
+    # -- checkpoint
+    checkpoint_saver = AsyncCheckpointSaver() if is_main else None
 
     best_val_acc = 0
     best_val_loss = np.inf
@@ -105,85 +132,96 @@ def train(data_dir, model_dir, args):
     
     for epoch in range(args.epochs):
         # train loop
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
         model.train()
-        loss_value = 0
-        matches = 0
-        for idx, train_batch in enumerate(train_loader):
+        loss_value = torch.zeros((), device=device)
+        matches = torch.zeros((), dtype=torch.long, device=device)
+        for idx, train_batch in enumerate(train_prefetcher):
             inputs, labels = train_batch
-            
-            inputs = inputs.to(device)
-            labels = labels.to(device)
+            if batch_transform is not None:
+                inputs = batch_transform(inputs)
 
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
 
-            outs = model(inputs)
-            
+            with torch.cuda.amp.autocast(enabled=use_cuda):
+                outs = model(inputs)
+                loss = criterion(outs, labels)
             preds = torch.argmax(outs, dim=-1)
-            loss = criterion(outs, labels)
 
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
-            loss_value += loss.item()
-            matches += (preds == labels).sum().item()
+            loss_value += loss.detach()
+            matches += (preds == labels).sum()
             if (idx + 1) % args.log_interval == 0:
-                train_loss = loss_value / args.log_interval
-                train_acc = matches / args.batch_size / args.log_interval
-                current_lr = get_lr(optimizer)
-                print(
-                    f"Epoch[{epoch}/{args.epochs}]({idx + 1}/{len(train_loader)}) || "
-                    f"training loss {train_loss:4.4} || training accuracy {train_acc:4.2%} || lr {current_lr}"
-                )
-                logger.add_scalar("Train/loss", train_loss, epoch * len(train_loader) + idx)
-                logger.add_scalar("Train/accuracy", train_acc, epoch * len(train_loader) + idx)
-
-                loss_value = 0
-                matches = 0
+                if is_main:
+                    train_loss = loss_value.item() / args.log_interval
+                    train_acc = matches.item() / args.batch_size / args.log_interval
+                    current_lr = get_lr(optimizer)
+                    print(
+                        f"Epoch[{epoch}/{args.epochs}]({idx + 1}/{len(train_loader)}) || "
+                        f"training loss {train_loss:4.4} || training accuracy {train_acc:4.2%} || lr {current_lr}"
+                    )
+                    logger.add_scalar("Train/loss", train_loss, epoch * len(train_loader) + idx)
+                    logger.add_scalar("Train/accuracy", train_acc, epoch * len(train_loader) + idx)
+
+                loss_value.zero_()
+                matches.zero_()
 
         scheduler.step()
 
         # val loop
-        with torch.no_grad():
-            print("Calculating validation results...")
+        with torch.inference_mode():
+            if is_main:
+                print("Calculating validation results...")
             model.eval()
-            val_loss_items = []
-            val_acc_items = []
-            predicts, answers = [], []
+            val_loss_sum = torch.zeros((), device=device)
+            val_acc_sum = torch.zeros((), dtype=torch.long, device=device)
+            cm = torch.zeros(num_classes, num_classes, dtype=torch.long, device=device)
             figure = None
-            for val_batch in val_loader:
+            for val_batch in val_prefetcher:
                 inputs, labels = val_batch
-                inputs = inputs.to(device)
-                labels = labels.to(device)
+                if val_batch_transform is not None:
+                    inputs = val_batch_transform(inputs)
 
-                outs = model(inputs)
+                outs = eval_model(inputs)
                 preds = torch.argmax(outs, dim=-1)
 
-                loss_item = criterion(outs, labels).item()
-                acc_item = (labels == preds).sum().item()
-                val_loss_items.append(loss_item)
-                val_acc_items.append(acc_item)
-
-                if figure is None:
-                    inputs_np = torch.clone(inputs).detach().cpu().permute(0, 2, 3, 1).numpy()
-                    inputs_np = dataset_module.denormalize_image(inputs_np, dataset.mean, dataset.std)
-                    figure = grid_image(
-                        inputs_np, labels, preds, n=16, shuffle=args.dataset != "MaskSplitByProfileDataset"
-                    )
-
-                answers.extend(labels.cpu().numpy())
-                predicts.extend(preds.cpu().numpy())
-
-            val_loss = np.sum(val_loss_items) / len(val_loader)
-            val_acc = np.sum(val_acc_items) / len(val_set)
-            val_f1_score = f1_score(answers, predicts, average='macro')
+                val_loss_sum += criterion(outs, labels)
+                val_acc_sum += (labels == preds).sum()
+                update_confusion_matrix(cm, labels, preds)
+
+                if figure is None and is_main:
+                    # only the 16 plotted samples leave the GPU
+                    if args.dataset != "MaskSplitByProfileDataset":
+                        choices = torch.randperm(labels.size(0), device=device)[:16]
+                    else:
+                        choices = torch.arange(16, device=device)
+                    inputs_np = denormalize_batch(inputs[choices], dataset.mean, dataset.std)
+                    figure = grid_image(inputs_np, labels[choices], preds[choices], n=16)
+
+            # merge every rank's shard, then only rank 0 reports and writes checkpoints
+            num_val_batches = torch.tensor(len(val_loader), device=device)
+            all_reduce_sum([num_val_batches, val_loss_sum, val_acc_sum, cm], distributed)
+            if not is_main:
+                continue
+
+            # metrics are computed once per epoch from the confusion matrix
+            answers, predicts = confusion_matrix_to_labels(cm.cpu().numpy())
+            val_loss = val_loss_sum.item() / num_val_batches.item()
+            val_acc = val_acc_sum.item() / len(answers)
+            val_f1_score = macro_f1_score(cm).item()
             best_val_loss = min(best_val_loss, val_loss)
 
             classification_result = classification_report(answers, predicts)
 
+            checkpoint_paths = [f"{save_dir}/last.pth"]
             if val_f1_score > best_val_f1_score:
                 print(f"New best model for val f1 score : {val_f1_score:4.2}! saving the best model..")
                 print(f"New best model for val accuracy : {val_acc:4.2%}!")
-                torch.save(model.module.state_dict(), f"{save_dir}/best.pth")
+                checkpoint_paths.append(f"{save_dir}/best.pth")
                 best_val_f1_score = val_f1_score
                 best_val_acc = val_acc
 
@@ -191,7 +229,7 @@ def train(data_dir, model_dir, args):
                 with open(f"{save_dir}/classification_result_of_best_model.txt", "w") as f:
                     f.write(classification_result)
 
-            torch.save(model.module.state_dict(), f"{save_dir}/last.pth")
+            checkpoint_saver.save(model, *checkpoint_paths)
             print(
                 f"[Val] acc : {val_acc:4.2%}, loss: {val_loss:4.2}, f1 score: {val_f1_score:4.2} || "
                 f"best acc : {best_val_acc:4.2%}, best loss: {best_val_loss:4.2}, best f1: {best_val_f1_score:4.2}"
@@ -202,6 +240,11 @@ def train(data_dir, model_dir, args):
             logger.add_figure("results", figure, epoch)
             print()
 
+    if checkpoint_saver is not None:
+        checkpoint_saver.close()
+    if distributed:
+        torch.distributed.destroy_process_group()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -227,6 +270,7 @@ if __name__ == '__main__':
     parser.add_argument('--lr_decay_step', type=int, default=20, help='learning rate scheduler deacy step (default: 20)')
     parser.add_argument('--log_interval', type=int, default=20, help='how many batches to wait before logging training status')
     parser.add_argument('--name', default='exp', help='model save at {SM_MODEL_DIR}/{name}')
+    parser.add_argument('--compile', type=int, default=0, help='compile the model with torch.compile for torchrun / single GPU runs (default: 0)')
     parser.add_argument('--config', '-c', default='./config.json', type=str, help='config file path 건드릴 필요 없음. (default: ./config.json)')
 
     # Container environment
@@ -1,9 +1,8 @@
 import argparse
 import json
-import multiprocessing
 import os
+import random
 from importlib import import_module
-from sklearn.metrics import f1_score
 import seaborn as sns
 import pandas as pd
 from tqdm import tqdm
@@ -14,14 +13,18 @@ sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
 import numpy as np
 import torch
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
 from torch.optim.lr_scheduler import StepLR
 import warnings
 
 from dataset import SubDataset
-from loss import create_criterion
+from loss import create_criterion, mixed_cross_entropy
 import opt
-from util import draw_confusion_matrix, seed_everything, increment_path, grid_image, read_json, update_argument
+from util import draw_confusion_matrix, seed_everything, increment_path, grid_image, read_json, update_argument, \
+    denormalize_batch, init_distributed, enable_fast_kernels, get_num_workers, shard_validation_set, wrap_model, \
+    all_reduce_sum, CUDAPrefetcher, AsyncCheckpointSaver, update_confusion_matrix, macro_f1_score, \
+    confusion_matrix_to_labels
 
 # 경고메세지 끄기
 warnings.filterwarnings(action='ignore')
@@ -30,32 +33,45 @@ warnings.filterwarnings(action='ignore')
 def rand_bbox(size, lam):  # size : [Batch_size, Channel, Width, Height]
     W = size[2]
     H = size[3]
-    cut_rat = np.sqrt(1. - lam)  # 패치 크기 비율
-    cut_w = np.int(W * cut_rat)
-    cut_h = np.int(H * cut_rat)
+    cut_rat = (1. - lam) ** 0.5  # 패치 크기 비율
+    cut_h = int(H * cut_rat)
 
-    # 패치의 중앙 좌표 값 cx, cy
-    cx = np.random.randint(W)
-    cy = np.random.randint(H)
+    # 패치의 중앙 좌표 값 cy (패치는 W 방향 전체를 덮으므로 cx 는 필요 없음)
+    cy = random.randrange(H)
 
     # 패치 모서리 좌표 값
     bbx1 = 0
-    bby1 = np.clip(cy - cut_h // 2, 0, H)
+    bby1 = max(cy - cut_h // 2, 0)
     bbx2 = W
-    bby2 = np.clip(cy + cut_h // 2, 0, H)
+    bby2 = min(cy + cut_h // 2, H)
 
     return bbx1, bby1, bbx2, bby2
 
 
+def cutmix(inputs, lam):
+    """ 섞인 이미지, 섞을 상대의 index, 패치 면적으로 보정한 lam 을 반환합니다 (원본 inputs 는 그대로 둠) """
+    rand_index = torch.randperm(inputs.size()[0], device=inputs.device)
+    bbx1, bby1, bbx2, bby2 = rand_bbox(inputs.size(), lam)
+    # 패치는 bbx 방향 전체를 덮으므로 마지막 축에 대한 mask 하나로 섞음
+    mask = torch.zeros(inputs.size()[-1], dtype=inputs.dtype, device=inputs.device)
+    mask[bby1:bby2] = 1
+    mixed = torch.lerp(inputs, inputs[rand_index], mask)
+    lam = 1 - ((bbx2 - bbx1) * (bby2 - bby1) / (inputs.size()[-1] * inputs.size()[-2]))
+    return mixed, rand_index, lam
+
+
 def train(data_dir, model_dir, args):
     seed_everything(args.seed)
+    enable_fast_kernels()
 
     save_dir = increment_path(os.path.join(model_dir, args.name))
 
     # -- settings
     # config = ConfigParser("./config.json")
+    distributed, rank, local_rank = init_distributed()
+    is_main = rank == 0
     use_cuda = torch.cuda.is_available()
-    device = torch.device("cuda" if use_cuda else "cpu")
+    device = torch.device("cuda", local_rank) if use_cuda else torch.device("cpu")
 
 
     # -- dataset
@@ -80,29 +96,43 @@ def train(data_dir, model_dir, args):
         std=dataset.std,
     )
 
+    # GPU*Augmentation 은 flip / normalize 를 batch 단위로 GPU 에서 수행 (그 외 augmentation 은 None)
+    batch_transform = getattr(transform, "batch_transform", None)
+    val_batch_transform = getattr(val_transform, "batch_transform", None)
+
     # -- data_loader
     train_set, val_set = dataset.split_dataset()
     train_set = SubDataset(train_set, transform=transform)
     val_set = SubDataset(val_set, transform=val_transform)
 
+    train_sampler = DistributedSampler(train_set) if distributed else None
+    val_set = shard_validation_set(val_set, distributed)
+
+    num_workers = get_num_workers()
     train_loader = DataLoader(
         train_set,
         batch_size=args.batch_size,
-        num_workers=multiprocessing.cpu_count()//2,
-        shuffle=True,
-        # pin_memory=use_cuda,
+        num_workers=num_workers,
+        persistent_workers=True,
+        prefetch_factor=4,
+        shuffle=train_sampler is None,
+        sampler=train_sampler,
+        pin_memory=use_cuda,
         # drop_last=True,
     )
 
     val_loader = DataLoader(
         val_set,
         batch_size=args.valid_batch_size,
-        num_workers=multiprocessing.cpu_count()//2,
+        num_workers=num_workers,
+        persistent_workers=True,
+        prefetch_factor=4,
         shuffle=False,
-        # pin_memory=use_cuda,
+        pin_memory=use_cuda,
         # drop_last=True,
     )
-
+    train_prefetcher = CUDAPrefetcher(train_loader, device, memory_format=torch.channels_last)
+    val_prefetcher = CUDAPrefetcher(val_loader, device, memory_format=torch.channels_last)
 
     # -- model
     model_module = getattr(import_module("model"), args.model)  # default: BaseModel
@@ -118,10 +148,11 @@ def train(data_dir, model_dir, args):
         model.eval()
 
     model = model.to(device)
-    model = torch.nn.DataParallel(model)
+    model, eval_model = wrap_model(model, distributed, local_rank, compile=args.compile)
 
     # -- loss & metric
     criterion = create_criterion(args.criterion)  # default: cross_entropy
+    fused_mix_loss = isinstance(criterion, torch.nn.CrossEntropyLoss)  # cutmix loss 를 log_softmax 한 번으로 계산
     base_optimizer = None
     if args.optimizer == "SAM":
         base_optimizer = getattr(import_module("torch.optim"), args.base_optimizer)
@@ -143,108 +174,133 @@ def train(data_dir, model_dir, args):
     # scheduler = StepLR(optimizer, args.lr_decay_step, gamma=0.5)
 
     # -- logging
-    logger = SummaryWriter(log_dir=os.path.join(save_dir, "tensorboard"))
-    with open(os.path.join(save_dir, 'config.json'), 'w', encoding='utf-8') as f:
-        json.dump(vars(args), f, ensure_ascii=False, indent=4)
+    if is_main:
+        logger = SummaryWriter(log_dir=os.path.join(save_dir, "tensorboard"))
+        with open(os.path.join(save_dir, 'config.json'), 'w', encoding='utf-8') as f:
+            json.dump(vars(args), f, ensure_ascii=False, indent=4)
+
+    # -- mixed precision
+    scaler = torch.cuda.amp.GradScaler(enabled=use_cuda)
+
+    # -- checkpoint
+    checkpoint_saver = AsyncCheckpointSaver() if is_main else None
+
+    def compute_loss(inputs, labels, target_b=None, lam=None):
+        with torch.cuda.amp.autocast(enabled=use_cuda):
+            outs = model(inputs)
+            if target_b is None:
+                return criterion(outs, labels)
+            # cutmix가 실행된 경우: 패치 이미지와 원본 이미지의 비율에 맞게
+            if fused_mix_loss:
+                return mixed_cross_entropy(outs, labels, target_b, lam)
+            return criterion(outs, labels) * lam + criterion(outs, target_b) * (1. - lam)
+
+    cutmix_on = args.beta > 0 and args.cutmix_prob > 0
+    is_sam = isinstance(optimizer, opt.SAM)
 
     best_val_loss = np.inf
     best_f1_score = 0
 
-    for epoch in tqdm(range(args.epochs)):
+    for epoch in tqdm(range(args.epochs), disable=not is_main):
         # train loop
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
         model.train()
 
-        train_loss = 0
+        train_loss = torch.zeros((), device=device)
+
+        # cutmix 적용 여부와 lambda 를 epoch 단위로 미리 뽑아둠
+        if cutmix_on:
+            cutmix_flags = (torch.rand(len(train_loader)) < args.cutmix_prob).tolist()
+            lams = torch.distributions.Beta(args.beta, args.beta).sample((len(train_loader),)).tolist()
+        else:
+            cutmix_flags = [False] * len(train_loader)
 
-        for idx, train_batch in enumerate(train_loader):
+        for idx, train_batch in enumerate(train_prefetcher):
             inputs, labels = train_batch
-            inputs = inputs.to(device)
-            labels = labels.to(device)
-
-            optimizer.zero_grad()
-            r = np.random.rand(1)
-
-            def closure():
-                if args.beta > 0 and r < args.cutmix_prob: # cutmix가 실행된 경우
-                    lam = np.random.beta(args.beta, args.beta)
-                    rand_index = torch.randperm(inputs.size()[0]).to(device)
-                    target_a = labels
-                    target_b = labels[rand_index]
-                    bbx1, bby1, bbx2, bby2 = rand_bbox(inputs.size(), lam)
-                    inputs[:, :, bbx1:bbx2, bby1:bby2] = inputs[rand_index, :, bbx1:bbx2, bby1:bby2]
-                    lam = 1 - ((bbx2 - bbx1) * (bby2 - bby1) / (inputs.size()[-1] * inputs.size()[-2]))
-                    outs = model(inputs)
-                    # 패치 이미지와 원본 이미지의 비율에 맞게
-                    loss = criterion(outs, target_a) * lam + criterion(outs, target_b) * (1. - lam)
-                else:
-                    outs = model(inputs)
-                    loss = criterion(outs, labels)
-                return loss
-
-            loss = closure()
-            loss.backward()
-
-            if isinstance(optimizer, opt.SAM):
+            if batch_transform is not None:
+                inputs = batch_transform(inputs)
+
+            optimizer.zero_grad(set_to_none=True)
+
+            # SAM 의 두 forward 가 같은 loss 를 보도록 섞는 것은 step 당 한 번만
+            if cutmix_flags[idx]:
+                inputs, rand_index, lam = cutmix(inputs, lams[idx])
+                target_b = labels[rand_index]
+            else:
+                target_b, lam = None, None
+
+            loss = compute_loss(inputs, labels, target_b, lam)
+            scaler.scale(loss).backward()
+
+            if is_sam:
+                # SAM wraps base_optimizer, so each of its two steps gets its own unscale_ record
+                scaler.unscale_(optimizer)
                 optimizer.first_step(zero_grad=True)
-                loss = closure()
-                loss.backward()
-                optimizer.second_step(zero_grad=True)
+                loss = compute_loss(inputs, labels, target_b, lam)
+                scaler.scale(loss).backward()
+                scaler.unscale_(optimizer.base_optimizer)
+                optimizer.second_step(zero_grad=True, scaler=scaler)
             else:
-                optimizer.step()
-            train_loss += loss.item()
+                scaler.step(optimizer)
+            scaler.update()
+            train_loss += loss.detach()
 
-        train_loss = train_loss / len(train_loader)
+        train_loss = (train_loss / len(train_loader)).item()
 
         scheduler.step()
 
         # val loop
-        with torch.no_grad():
+        with torch.inference_mode():
             model.eval()
-            val_loss_items = []
-            val_acc_items = []
+            val_loss_sum = torch.zeros((), device=device)
+            val_acc_sum = torch.zeros((), dtype=torch.long, device=device)
             figure = None
 
-            epoch_f1 = 0
-            y_pred = np.array([])
-            y_true = np.array([])
+            cm = torch.zeros(num_classes, num_classes, dtype=torch.long, device=device)
 
-            for val_batch in val_loader:
+            for val_batch in val_prefetcher:
                 inputs, labels = val_batch
-                inputs = inputs.to(device)
-                labels = labels.to(device)
+                if val_batch_transform is not None:
+                    inputs = val_batch_transform(inputs)
 
-                outs = model(inputs)
+                outs = eval_model(inputs)
                 preds = torch.argmax(outs, dim=-1)
 
-                epoch_f1 += f1_score(labels.cpu().numpy(), preds.cpu().numpy(), average='macro')
+                update_confusion_matrix(cm, labels, preds)
 
-                loss_item = criterion(outs, labels).item()
-                acc_item = (labels == preds).sum().item()
-                val_loss_items.append(loss_item)
-                val_acc_items.append(acc_item)
+                val_loss_sum += criterion(outs, labels)
+                val_acc_sum += (labels == preds).sum()
 
-                y_pred = np.concatenate([y_pred, preds.cpu().view(-1).numpy()])
-                y_true = np.concatenate([y_true, labels.cpu().view(-1).numpy()])
-                if figure is None:
-                    inputs_np = torch.clone(inputs).detach().cpu().permute(0, 2, 3, 1).numpy()
-                    inputs_np = dataset_module.denormalize_image(inputs_np, dataset.mean, dataset.std)
-                    figure = grid_image(
-                        inputs_np, labels, preds, n=16, shuffle=args.dataset != "MaskSplitByProfileDataset"
-                    )
+                if figure is None and is_main:
+                    # only the 16 plotted samples leave the GPU
+                    if args.dataset != "MaskSplitByProfileDataset":
+                        choices = torch.randperm(labels.size(0), device=device)[:16]
+                    else:
+                        choices = torch.arange(16, device=device)
+                    inputs_np = denormalize_batch(inputs[choices], dataset.mean, dataset.std)
+                    figure = grid_image(inputs_np, labels[choices], preds[choices], n=16)
 
-            val_loss = np.sum(val_loss_items) / len(val_loader)
-            val_acc = np.sum(val_acc_items) / len(val_set)
+            # merge every rank's shard, then only rank 0 reports and writes checkpoints
+            num_val_batches = torch.tensor(len(val_loader), device=device)
+            all_reduce_sum([num_val_batches, val_loss_sum, val_acc_sum, cm], distributed)
+            if not is_main:
+                continue
 
-            epoch_f1 /= len(val_loader)
+            epoch_f1 = macro_f1_score(cm).item()
+            val_loss = val_loss_sum.item() / num_val_batches.item()
+            val_acc = val_acc_sum.item() / cm.sum().item()
 
             best_val_loss = min(best_val_loss, val_loss)
 
+            checkpoint_paths = [f"{save_dir}/last.pth"]
             if epoch_f1 > best_f1_score:
-                torch.save(model.module.state_dict(), f"{save_dir}/best.pth")
+                checkpoint_paths.append(f"{save_dir}/best.pth")
                 best_f1_score = epoch_f1
+                y_true, y_pred = confusion_matrix_to_labels(cm.cpu().numpy())
                 draw_confusion_matrix(y_true, y_pred, save_dir, num_classes)
 
-            torch.save(model.module.state_dict(), f"{save_dir}/last.pth")
+            checkpoint_saver.save(model, *checkpoint_paths)
 
             # write log
             with open(os.path.join(save_dir, 'log.log'), 'a', encoding='utf-8') as f:
@@ -259,6 +315,11 @@ def train(data_dir, model_dir, args):
             logger.add_scalar("Val/f1_score", epoch_f1, epoch)
             logger.add_figure("results", figure, epoch)
 
+    if checkpoint_saver is not None:
+        checkpoint_saver.close()
+    if distributed:
+        torch.distributed.destroy_process_group()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -280,6 +341,7 @@ if __name__ == '__main__':
     parser.add_argument('--lr_decay_step', type=int, default=20, help='learning rate scheduler deacy step (default: 20)')
     parser.add_argument('--log_interval', type=int, default=20, help='how many batches to wait before logging training status')
     parser.add_argument('--name', default='exp', help='model save at {SM_MODEL_DIR}/{name}')
+    parser.add_argument('--compile', type=int, default=0, help='compile the model with torch.compile for torchrun / single GPU runs (default: 0)')
 
     parser.add_argument('--pretrained', default=True, help='use pretrained model')
     parser.add_argument('--model_name', default='vit_base_patch16_224', help="pretrained model name")
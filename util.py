@@ -1,15 +1,21 @@
 from pathlib import Path
+import os
+import multiprocessing
 import json
 import glob
 import re
 import random
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 import seaborn as sns
 from sklearn.metrics import confusion_matrix
 import pandas as pd
 import numpy as np
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import Subset
 
 from dataset import MaskBaseDataset
 
@@ -58,13 +64,174 @@ def draw_confusion_matrix(true, pred, dir, num_classes):
     plt.close('all')
 
 
+def update_confusion_matrix(cm, labels, preds):
+    """ Add a batch to a (num_classes, num_classes) confusion matrix tensor in place, without a host sync.
+
+    torch.bincount is avoided on purpose: on CUDA it reads min/max back to the host to size its output.
+    """
+    num_classes = cm.size(0)
+    cm.view(-1).index_add_(0, labels * num_classes + preds, torch.ones_like(labels))
+
+
+def macro_f1_score(cm):
+    """ Macro F1 score from a confusion matrix tensor (rows: true, columns: predicted).
+
+    Classes that appear neither in the targets nor in the predictions are ignored, like sklearn's f1_score.
+    """
+    tp = cm.diag().float()
+    denom = cm.sum(dim=0).float() + cm.sum(dim=1).float()  # 2 * TP + FP + FN
+    present = denom > 0
+    return (2 * tp[present] / denom[present]).mean()
+
+
+def confusion_matrix_to_labels(cm):
+    """ Expand a numpy confusion matrix back into (true, pred) label arrays. """
+    num_classes = cm.shape[0]
+    counts = cm.reshape(-1)
+    true = np.repeat(np.repeat(np.arange(num_classes), num_classes), counts)
+    pred = np.repeat(np.tile(np.arange(num_classes), num_classes), counts)
+    return true, pred
+
+
 def seed_everything(seed):
+    # train / val split (np.random / random_split) 도 seed 로 고정 -> torchrun 의 모든 rank 가 같은 split 을 사용
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)  # if use multi-GPU
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.benchmark = False
 
 
+def init_distributed():
+    """ Initialize the NCCL process group when launched by torchrun.
+
+    Returns:
+        (distributed, rank, local_rank). Falls back to (False, 0, 0) for a plain `python` launch.
+    """
+    if "LOCAL_RANK" not in os.environ:
+        return False, 0, 0
+    local_rank = int(os.environ["LOCAL_RANK"])
+    torch.cuda.set_device(local_rank)
+    dist.init_process_group("nccl")
+    return True, dist.get_rank(), local_rank
+
+
+def enable_fast_kernels():
+    """ Input shape is fixed, so let cuDNN pick the fastest kernels once; TF32 for fp32 matmul/conv on Ampere+. """
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+
+def get_num_workers():
+    """ DataLoader workers per loader, capped so that train + val workers do not oversubscribe large nodes
+    or exhaust shared memory.
+    """
+    return max(2, min(8, multiprocessing.cpu_count() // 2))
+
+
+def shard_validation_set(val_set, distributed):
+    """ Give each rank a disjoint slice of val_set. DistributedSampler would pad it with duplicated samples. """
+    if not distributed:
+        return val_set
+    return Subset(val_set, range(dist.get_rank(), len(val_set), dist.get_world_size()))
+
+
+def wrap_model(model, distributed, local_rank, compile=False):
+    """ Convert to channels_last, optionally torch.compile, and wrap for multi-GPU training.
+
+    Returns:
+        (model, eval_model). Validation shards have different lengths, so under DDP eval_model is the
+        unwrapped module (no collectives in forward).
+    """
+    model = model.to(memory_format=torch.channels_last)
+    # torch.compile (torch>=2.0) does not support DataParallel replication over several GPUs
+    if compile and hasattr(torch, "compile") and (distributed or torch.cuda.device_count() <= 1):
+        model = torch.compile(model)
+    if distributed:
+        model = DistributedDataParallel(model, device_ids=[local_rank])
+        return model, model.module
+    model = torch.nn.DataParallel(model)
+    return model, model
+
+
+def all_reduce_sum(tensors, distributed):
+    """ Sum metric tensors over all ranks in place (no-op when not distributed). """
+    if distributed:
+        for tensor in tensors:
+            dist.all_reduce(tensor)
+
+
+def unwrap_model(model):
+    """ Strip DataParallel / DistributedDataParallel and torch.compile wrappers, e.g. before saving a state_dict. """
+    if isinstance(model, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)):
+        model = model.module
+    return getattr(model, "_orig_mod", model)
+
+
+class CUDAPrefetcher:
+    """ Wrap a DataLoader so that the host-to-device copy of the next batch runs on a side
+    CUDA stream while the current batch is being processed. Falls back to plain copies on CPU.
+    """
+
+    def __init__(self, loader, device, memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.device = device
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        batch = self._preload(loader_iter)
+        while batch is not None:
+            if self.stream is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                for tensor in batch:
+                    tensor.record_stream(current_stream)
+            next_batch = self._preload(loader_iter)
+            yield batch
+            batch = next_batch
+
+    def _preload(self, loader_iter):
+        try:
+            inputs, labels = next(loader_iter)
+        except StopIteration:
+            return None
+        if self.stream is None:
+            return inputs.to(self.device, memory_format=self.memory_format), labels.to(self.device)
+        with torch.cuda.stream(self.stream):
+            inputs = inputs.to(self.device, non_blocking=True, memory_format=self.memory_format)
+            labels = labels.to(self.device, non_blocking=True)
+        return inputs, labels
+
+
+class AsyncCheckpointSaver:
+    """ Copy the model weights to the CPU once and write them to disk on a background thread. """
+
+    def __init__(self):
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._futures = []
+
+    def save(self, model, *paths):
+        self._check_errors()
+        state = {k: v.detach().to("cpu", copy=True) for k, v in unwrap_model(model).state_dict().items()}
+        self._futures = [self._pool.submit(torch.save, state, path) for path in paths]
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        self._check_errors()
+
+    def _check_errors(self):
+        for future in self._futures:
+            future.result()  # waits for the previous write and re-raises its error, if any
+
+
 def get_lr(optimizer):
     for param_group in optimizer.param_groups:
         return param_group['lr']
@@ -88,6 +255,14 @@ def increment_path(path, exist_ok=False):
         return f"{path}{n}"
 
 
+def denormalize_batch(images, mean, std):
+    """ Denormalize an NCHW image tensor on its own device and return NHWC uint8 numpy images for grid_image. """
+    mean = torch.tensor(mean, dtype=torch.float32, device=images.device).view(1, -1, 1, 1)
+    std = torch.tensor(std, dtype=torch.float32, device=images.device).view(1, -1, 1, 1)
+    images = (images.float() * std + mean).clamp(0, 1) * 255.0
+    return images.permute(0, 2, 3, 1).to(torch.uint8).cpu().numpy()
+
+
 def grid_image(np_images, gts, preds, n=16, shuffle=False):
     batch_size = np_images.shape[0]
     assert n <= batch_size